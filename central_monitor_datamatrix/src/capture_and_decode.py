@@ -1,14 +1,22 @@
 from __future__ import annotations
 
 import argparse
+import heapq
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Iterable, List
+from typing import Iterable, List, Optional, Tuple
 
 from PIL import Image
 
-from dm_codec import decode_payload, verify_crc32
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
+
+from dm_codec import decode_frame, unpack_frame, verify_crc32
 from dm_decoder import decode_datamatrix_from_image
 
 
@@ -17,11 +25,13 @@ def iter_input_images(path: Path, latest_n: int) -> Iterable[Path]:
         yield path
         return
 
-    exts = {".png", ".jpg", ".jpeg", ".bmp"}
-    images: List[Path] = [p for p in path.iterdir() if p.suffix.lower() in exts]
-    images.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    for p in reversed(images[:latest_n]):
-        yield p
+    exts = (".png", ".jpg", ".jpeg", ".bmp")
+    # DirEntry は readdir の結果を持っているので、名前での絞り込みに stat は要らない
+    with os.scandir(path) as it:
+        entries: List[os.DirEntry] = [e for e in it if e.name.lower().endswith(exts) and e.is_file()]
+    latest = heapq.nlargest(latest_n, entries, key=lambda e: e.stat().st_mtime)
+    for e in reversed(latest):
+        yield Path(e.path)
 
 
 def crop_bottom_right(image: Image.Image, roi_size: int) -> Image.Image:
@@ -33,9 +43,39 @@ def crop_bottom_right(image: Image.Image, roi_size: int) -> Image.Image:
 
 def append_jsonl(records: list[dict], out_path: Path) -> None:
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("a", encoding="utf-8") as f:
-        for rec in records:
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    if orjson is not None:
+        buf = b"".join(orjson.dumps(rec) + b"\n" for rec in records)
+    else:
+        buf = "".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in records).encode("utf-8")
+    with out_path.open("ab") as f:
+        f.write(buf)
+
+
+def _process_one(img_path: Path, roi_size: int) -> Tuple[str, Optional[dict]]:
+    try:
+        # ROI だけを切り出してから輝度に変換する（スクショ全体を RGB 展開しない）
+        with Image.open(img_path) as img:
+            roi = crop_bottom_right(img, roi_size).convert("L")
+        blob = decode_datamatrix_from_image(roi)
+        if blob is None:
+            return f"decode failed: {img_path}", None
+
+        frame = unpack_frame(blob)
+        crc_ok = verify_crc32(frame)
+        if not crc_ok:
+            return f"crc mismatch: {img_path}", None
+
+        payload = decode_frame(frame)
+
+        record = {
+            "source_image": str(img_path),
+            "decoded_at": datetime.now().isoformat(),
+            "crc_ok": crc_ok,
+            "payload": payload,
+        }
+        return f"ok: {img_path}", record
+    except Exception as exc:
+        return f"error [{img_path}]: {exc}", None
 
 
 def main() -> None:
@@ -44,38 +84,27 @@ def main() -> None:
     ap.add_argument("--latest-n", type=int, default=10)
     ap.add_argument("--roi-size", type=int, default=420)
     ap.add_argument("--output-root", default="../dataset")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="decode並列プロセス数(1で逐次)")
     args = ap.parse_args()
 
     input_path = Path(args.input)
     today_dir = datetime.now().strftime("%Y%m%d")
     out_path = Path(args.output_root) / today_dir / "dm_results.jsonl"
 
+    img_paths = list(iter_input_images(input_path, args.latest_n))
+    roi_sizes = [args.roi_size] * len(img_paths)
+    workers = max(1, min(args.workers, len(img_paths)))
+    if workers == 1:
+        outcomes = list(map(_process_one, img_paths, roi_sizes))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outcomes = list(pool.map(_process_one, img_paths, roi_sizes))
+
     results: list[dict] = []
-    for img_path in iter_input_images(input_path, args.latest_n):
-        try:
-            img = Image.open(img_path).convert("RGB")
-            roi = crop_bottom_right(img, args.roi_size)
-            blob = decode_datamatrix_from_image(roi)
-            if blob is None:
-                print(f"decode failed: {img_path}")
-                continue
-
-            payload = decode_payload(blob)
-            crc_ok = verify_crc32(payload)
-            if not crc_ok:
-                print(f"crc mismatch: {img_path}")
-                continue
-
-            record = {
-                "source_image": str(img_path),
-                "decoded_at": datetime.now().isoformat(),
-                "crc_ok": crc_ok,
-                "payload": payload,
-            }
+    for message, record in outcomes:
+        print(message)
+        if record is not None:
             results.append(record)
-            print(f"ok: {img_path}")
-        except Exception as exc:
-            print(f"error [{img_path}]: {exc}")
 
     append_jsonl(results, out_path)
     print(f"saved: {out_path} ({len(results)} records)")
@@ -2,32 +2,126 @@ from __future__ import annotations
 
 import json
 import zlib
-from typing import Any, Dict
+from typing import Any, Dict, Tuple, Union
 
+BytesLike = Union[bytes, bytearray, memoryview]
 
-def _canonical_json_bytes(payload: Dict[str, Any]) -> bytes:
-    return json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+try:
+    # isal の crc32 は PCLMULQDQ/PMULL の folding 実装。無ければ zlib にフォールバック。
+    from isal.isal_zlib import crc32 as _crc32
+except Exception:  # pragma: no cover
+    from zlib import crc32 as _crc32
 
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
 
-def add_crc32(payload_without_crc: Dict[str, Any]) -> Dict[str, Any]:
+# wire blob = header(1 byte) + frame（または zlib 圧縮した frame）
+# frame = crc32(8hex, ASCII) + canonical JSON(crc32 フィールド無し)
+CRC_HEX_LEN = 8
+# header の上位 4bit は frame version、下位 4bit は圧縮方式 (0: 無圧縮, 1: zlib)。
+# version 1 は header 無しで crc32 入りの JSON 全体を zlib 圧縮していた。zlib の先頭 byte は下位 4bit が 8 なので区別できる。
+FRAME_VERSION = 2
+HEADER_RAW = FRAME_VERSION << 4
+HEADER_ZLIB = FRAME_VERSION << 4 | 1
+# DataMatrix は内容が小さいほどモジュールが大きくなり読み取りやすいので、圧縮率を優先する
+ZLIB_LEVEL = 9
+
+
+# CRC の対象になる canonical JSON は常に標準 json で作る。orjson は指数表記の float (1e16 / 1e+16)、
+# NaN、64bit を超える int の出力が標準 json と違うため、入っている環境ごとに CRC が変わってしまう。
+_CANONICAL_ENCODER = json.JSONEncoder(ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def _canonical_json_bytes(payload: Any) -> bytes:
+    return _CANONICAL_ENCODER.encode(payload).encode("utf-8")
+
+
+def _canonical_json_bytes_without(payload: Dict[str, Any], skip_key: str) -> bytes:
+    # 外側の dict をコピーせず、skip_key を除いた canonical JSON を組み立てる
+    items = sorted((k, v) for k, v in payload.items() if k != skip_key)
+    return b"{" + b",".join(_canonical_json_bytes(k) + b":" + _canonical_json_bytes(v) for k, v in items) + b"}"
+
+
+def fast_crc32(data: bytes) -> int:
+    return _crc32(data) & 0xFFFFFFFF
+
+
+def add_crc32_frame(payload_without_crc: Dict[str, Any]) -> Tuple[Dict[str, Any], bytes]:
+    """crc32 を付けた payload と、同じ canonical JSON から作った wire frame を一度に返す。"""
+    body = _canonical_json_bytes(payload_without_crc)
+    crc_hex = f"{fast_crc32(body):08x}"
     data = dict(payload_without_crc)
-    crc = zlib.crc32(_canonical_json_bytes(data)) & 0xFFFFFFFF
-    data["crc32"] = f"{crc:08x}"
-    return data
+    data["crc32"] = crc_hex
+    return data, crc_hex.encode("ascii") + body
 
 
-def verify_crc32(payload: Dict[str, Any]) -> bool:
+def add_crc32(payload_without_crc: Dict[str, Any]) -> Dict[str, Any]:
+    return add_crc32_frame(payload_without_crc)[0]
+
+
+def verify_crc32(payload: Union[BytesLike, Dict[str, Any]]) -> bool:
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        given = bytes(payload[:CRC_HEX_LEN]).decode("ascii", errors="replace").lower()
+        return given == f"{fast_crc32(payload[CRC_HEX_LEN:]):08x}"
+
     given = str(payload.get("crc32", "")).lower()
-    data = dict(payload)
-    data.pop("crc32", None)
-    expected = f"{(zlib.crc32(_canonical_json_bytes(data)) & 0xFFFFFFFF):08x}"
+    expected = f"{fast_crc32(_canonical_json_bytes_without(payload, 'crc32')):08x}"
     return given == expected
 
 
+def encode_frame(frame: bytes) -> bytes:
+    compressed = zlib.compress(frame, level=ZLIB_LEVEL)
+    # ごく小さい frame は zlib のヘッダ分だけ膨らむので、その時だけ無圧縮で送る
+    if len(frame) <= len(compressed):
+        return bytes((HEADER_RAW,)) + frame
+    return bytes((HEADER_ZLIB,)) + compressed
+
+
 def encode_payload(payload: Dict[str, Any]) -> bytes:
-    return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), level=9)
+    # frame を持っていない呼び出し元向け。make_payload_frame の frame があれば encode_frame を直接使う
+    body = _canonical_json_bytes_without(payload, "crc32")
+    return encode_frame(f"{fast_crc32(body):08x}".encode("ascii") + body)
+
+
+def _frame_from_v1(raw: bytes) -> bytes:
+    # v1 の CRC は crc32 を除いた canonical JSON に対するものなので、v2 と同じ形の frame に組み直す
+    payload = json.loads(raw)
+    if not isinstance(payload, dict):
+        raise ValueError("DataMatrix v1 payload is not a JSON object")
+    crc = str(payload.pop("crc32", ""))
+    prefix = crc.encode("ascii", errors="replace")[:CRC_HEX_LEN].ljust(CRC_HEX_LEN, b"?")
+    return prefix + _canonical_json_bytes(payload)
+
+
+def unpack_frame(blob: BytesLike) -> bytes:
+    if not blob:
+        raise ValueError("empty DataMatrix blob")
+    header = blob[0]
+    if header == HEADER_RAW:
+        return bytes(blob[1:])
+    if header == HEADER_ZLIB:
+        return zlib.decompress(blob[1:])
+    if header & 0x0F == 8:
+        return _frame_from_v1(zlib.decompress(blob))
+    raise ValueError(f"unsupported DataMatrix frame header: 0x{header:02x}")
+
+
+def decode_frame(frame: BytesLike) -> Dict[str, Any]:
+    frame = bytes(frame)
+    body = frame[CRC_HEX_LEN:]
+    if orjson is not None:
+        try:
+            payload = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # 標準 json だけが出す NaN / Infinity は orjson では読めないので標準 json で読み直す
+            payload = json.loads(body)
+    else:
+        payload = json.loads(body)
+    payload["crc32"] = frame[:CRC_HEX_LEN].decode("ascii", errors="replace")
+    return payload
 
 
-def decode_payload(blob: bytes) -> Dict[str, Any]:
-    raw = zlib.decompress(blob)
-    return json.loads(raw.decode("utf-8"))
+def decode_payload(blob: BytesLike) -> Dict[str, Any]:
+    return decode_frame(unpack_frame(blob))
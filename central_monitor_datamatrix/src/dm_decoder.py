@@ -25,6 +25,9 @@ def decode_datamatrix_from_image(image: ImageLike) -> Optional[bytes]:
         pil_img = Image.fromarray(image)
     else:
         pil_img = image
+    # pylibdmtx は 8/24/32bpp のみ対応。P(パレット)や 1bit 等は輝度 "L" に落として渡す
+    if pil_img.mode not in ("L", "RGB", "RGBA"):
+        pil_img = pil_img.convert("L")
 
     decoded = decode(pil_img)
     if not decoded:
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
 
-from dm_codec import add_crc32
+from dm_codec import add_crc32_frame
+from timeutil import utcnow_iso
+
+# bed_name -> (bed_ts, sanitized bed)。bed_ts が変わらない限り前回の dict を再利用する。
+_BED_CACHE: Dict[str, Tuple[Any, Dict[str, Any]]] = {}
 
 
 def _sanitize_vital_entry(vital: Dict[str, Any]) -> Dict[str, Any]:
@@ -14,21 +17,39 @@ def _sanitize_vital_entry(vital: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def make_payload(monitor_cache_dict: Dict[str, Any], seq: int, schema_version: int = 1) -> Dict[str, Any]:
+def _sanitize_bed(bed_name: str, bed_info: Any) -> Dict[str, Any]:
+    bed_ts = bed_info.get("ts") if isinstance(bed_info, dict) else None
+    cached = _BED_CACHE.get(bed_name)
+    if cached is not None and bed_ts is not None and cached[0] == bed_ts:
+        return cached[1]
+
+    vitals = bed_info.get("vitals", {}) if isinstance(bed_info, dict) else {}
+    bed_out = {
+        "vitals": {k: _sanitize_vital_entry(v) for k, v in vitals.items() if isinstance(v, dict)},
+        "bed_ts": bed_ts,
+    }
+    _BED_CACHE[bed_name] = (bed_ts, bed_out)
+    return bed_out
+
+
+def make_payload_frame(
+    monitor_cache_dict: Dict[str, Any], seq: int, schema_version: int = 1
+) -> Tuple[Dict[str, Any], bytes]:
+    """payload と、CRC 計算に使った canonical JSON をそのまま使う wire frame を返す。"""
     beds_in = monitor_cache_dict.get("beds", {}) if isinstance(monitor_cache_dict, dict) else {}
     beds_out: Dict[str, Any] = {}
 
     for bed_name, bed_info in beds_in.items():
-        vitals = bed_info.get("vitals", {}) if isinstance(bed_info, dict) else {}
-        beds_out[bed_name] = {
-            "vitals": {k: _sanitize_vital_entry(v) for k, v in vitals.items() if isinstance(v, dict)},
-            "bed_ts": bed_info.get("ts"),
-        }
+        beds_out[bed_name] = _sanitize_bed(bed_name, bed_info)
 
     payload_wo_crc = {
         "v": schema_version,
-        "ts": datetime.now(timezone.utc).isoformat(),
+        "ts": utcnow_iso(),
         "seq": seq,
         "beds": beds_out,
     }
-    return add_crc32(payload_wo_crc)
+    return add_crc32_frame(payload_wo_crc)
+
+
+def make_payload(monitor_cache_dict: Dict[str, Any], seq: int, schema_version: int = 1) -> Dict[str, Any]:
+    return make_payload_frame(monitor_cache_dict, seq, schema_version)[0]
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from io import BytesIO
+from functools import lru_cache
 
 from PIL import Image
 
@@ -16,7 +16,14 @@ else:
 def render_datamatrix(data: bytes, size: int = 280) -> Image.Image:
     if encode is None:
         raise RuntimeError(f"pylibdmtx unavailable: {_IMPORT_ERROR}")
+    return _render_cached(bytes(data), size)
 
+
+@lru_cache(maxsize=4)
+def _render_cached(data: bytes, size: int) -> Image.Image:
+    # encode() は libdmtx の生ピクセル(24bpp RGB)を返すので、PNG を経由せず直接 Image にする
     encoded = encode(data)
-    image = Image.open(BytesIO(encoded.png)).convert("RGB")
+    image = Image.frombytes("RGB", (encoded.width, encoded.height), encoded.pixels)
+    if image.size == (size, size):
+        return image
     return image.resize((size, size), Image.NEAREST)
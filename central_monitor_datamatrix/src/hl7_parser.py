@@ -1,25 +1,40 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
+import math
+import re
 from typing import Any, Dict, List
 
+from timeutil import utcnow_iso
+
+# OBX|set-id|type|obs-id^text|sub-id|value|unit[|ref|flag]
+_OBX_RE = re.compile(r"OBX\|[^|]*\|[^|]*\|([^|^]*)[^|]*\|[^|]*\|([^|]*)\|([^|]*)(?:\|[^|]*\|([^|]*))?")
+# 数値として解釈し得る先頭文字。これ以外で始まる値は float() を試さず文字列のまま扱う
+_NUMERIC_START = frozenset("0123456789+-.")
+
 
 def _parse_obx_segments(segments: List[str]) -> Dict[str, Dict[str, Any]]:
     vitals: Dict[str, Dict[str, Any]] = {}
     for seg in segments:
-        fields = seg.split("|")
-        if len(fields) < 7 or fields[0] != "OBX":
+        m = _OBX_RE.match(seg)
+        if m is None:
             continue
 
-        obs_id = fields[3].split("^")[0].strip().upper() or "UNKNOWN"
-        value_raw = fields[5].strip()
-        unit = fields[6].strip() if len(fields) > 6 else ""
-        flag = fields[8].strip() if len(fields) > 8 else ""
+        obs_id_raw, value_raw, unit, flag = m.groups("")
+        obs_id = obs_id_raw.strip().upper() or "UNKNOWN"
+        value_raw = value_raw.strip()
+        unit = unit.strip()
+        flag = flag.strip()
 
-        try:
-            value = float(value_raw)
-        except ValueError:
-            value = value_raw
+        value: Any = value_raw
+        if value_raw and value_raw[0] in _NUMERIC_START:
+            try:
+                number = float(value_raw)
+            except ValueError:
+                pass
+            else:
+                # "-inf" / "+nan" / "1e999" なども "inf" / "nan" と同じく文字列のまま残す（JSON にできない）
+                if math.isfinite(number):
+                    value = number
 
         vitals[obs_id] = {
             "value": value,
@@ -36,11 +51,17 @@ def parse_hl7_message(raw_message: str) -> Dict[str, Any]:
     patient = {}
 
     for seg in segments:
-        fields = seg.split("|")
-        if fields[0] == "PV1" and len(fields) > 3:
-            pv1_parts = fields[3].split("^")
-            bed = pv1_parts[2] if len(pv1_parts) > 2 and pv1_parts[2] else fields[3] or "UNKNOWN"
-        if fields[0] == "PID":
+        seg_type = seg[:3]
+        # 必要なフィールドまでだけ split する（残りは末尾要素にまとめて残る）
+        if seg_type == "PV1":
+            fields = seg.split("|", 4)
+            if fields[0] == "PV1" and len(fields) > 3:
+                pv1_parts = fields[3].split("^", 3)
+                bed = pv1_parts[2] if len(pv1_parts) > 2 and pv1_parts[2] else fields[3] or "UNKNOWN"
+        elif seg_type == "PID":
+            fields = seg.split("|", 8)
+            if fields[0] != "PID":
+                continue
             patient = {
                 "patient_id": fields[3] if len(fields) > 3 else "",
                 "name": fields[5] if len(fields) > 5 else "",
@@ -50,7 +71,7 @@ def parse_hl7_message(raw_message: str) -> Dict[str, Any]:
     vitals = _parse_obx_segments(segments)
 
     return {
-        "ts": datetime.now(timezone.utc).isoformat(),
+        "ts": utcnow_iso(),
         "bed": bed,
         "patient": patient,
         "vitals": vitals,
@@ -2,73 +2,370 @@ from __future__ import annotations
 
 import argparse
 import json
+import os
+import selectors
 import socket
+import stat
+import tempfile
 import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Deque, Dict, List, Set, Tuple
 
 from hl7_parser import parse_hl7_message
+from timeutil import utcnow_iso
+
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
 
 SB = b"\x0b"
 EB_CR = b"\x1c\x0d"
+# ACK は内容が固定なので frame ごと組み立てておく
+ACK_FRAME = SB + b"MSA|AA|OK" + EB_CR
+
+RECV_BUF_SIZE = 65536
+# EB_CR が来ないまま溜まった frame がこれを超えたら接続を切る（受信バッファを無制限に伸ばさない）
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+# 1 接続で解析待ちの frame がこれ以上溜まったら、捌けるまでその接続からの読み込みを止める
+MAX_PENDING_FRAMES = 64
+# 無通信がこれを超えた接続は切断する（相手が消えた接続の fd を残さない）
+CLIENT_IDLE_TIMEOUT_S = 300.0
+# 連続して届いた更新はこの時間だけまとめてから monitor_cache.json に書き出す
+CACHE_FLUSH_DELAY_S = 0.1
+# umask は読むだけでも一度書き換える必要があるので、スレッドを起こす前の import 時に一度だけ取る
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 
 @dataclass
 class BedDataAggregator:
     beds: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    generation: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
 
     def update_from_parsed(self, parsed: Dict[str, Any]) -> None:
         bed = parsed.get("bed", "UNKNOWN")
-        self.beds[bed] = {
-            "ts": parsed.get("ts", datetime.now(timezone.utc).isoformat()),
+        entry = {
+            "ts": parsed.get("ts") or utcnow_iso(),
             "patient": parsed.get("patient", {}),
             "vitals": parsed.get("vitals", {}),
         }
+        with self._lock:
+            self.beds[bed] = entry
+            self.generation += 1
 
     def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            beds = dict(self.beds)
         return {
-            "ts": datetime.now(timezone.utc).isoformat(),
-            "beds": self.beds,
+            "ts": utcnow_iso(),
+            "beds": beds,
         }
 
 
-def _extract_mllp_payload(data: bytes) -> str:
-    start = data.find(SB)
-    end = data.find(EB_CR)
-    if start == -1 or end == -1 or end <= start:
-        return ""
-    return data[start + 1 : end].decode("utf-8", errors="ignore")
+def _dumps_bytes(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _cache_file_mode(path: Path) -> int:
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
 
 
-def _handle_client(conn: socket.socket, aggregator: BedDataAggregator, cache_path: Path) -> None:
+def _atomic_write_bytes(path: Path, data: bytes) -> None:
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
     try:
-        data = conn.recv(65535)
-        message = _extract_mllp_payload(data)
-        if not message:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp は常に 0600 で作るので、既存ファイルの権限（無ければ umask に従う通常の作成時の権限）に合わせる
+        os.chmod(tmp_name, _cache_file_mode(path))
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+class CacheWriter:
+    """aggregator の内容を monitor_cache.json へ書き出す。更新はまとめて、変化がある時だけ書く。"""
+
+    def __init__(self, aggregator: BedDataAggregator, cache_path: Path, delay_s: float = CACHE_FLUSH_DELAY_S) -> None:
+        self.aggregator = aggregator
+        self.cache_path = cache_path
+        self.delay_s = delay_s
+        self._dirty = threading.Event()
+        self._write_lock = threading.Lock()
+        self._written_generation = -1
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name="cache-writer", daemon=True).start()
+
+    def schedule(self) -> None:
+        # 受信スレッドはフラグを立てるだけで、シリアライズとディスク I/O は writer スレッドが行う
+        self._dirty.set()
+
+    def _run(self) -> None:
+        while True:
+            self._dirty.wait()
+            time.sleep(self.delay_s)
+            self._dirty.clear()
+            if not self.flush():
+                self._dirty.set()
+
+    def flush(self) -> bool:
+        with self._write_lock:
+            generation = self.aggregator.generation
+            if generation == self._written_generation:
+                return True
+            try:
+                _atomic_write_bytes(self.cache_path, _dumps_bytes(self.aggregator.snapshot()))
+            except OSError as exc:
+                print(f"cache write error: {exc}")
+                return False
+            self._written_generation = generation
+            return True
+
+
+def _extract_mllp_payload(buf: bytearray, start: int, end: int) -> str:
+    """buf[start:end] (EB_CR の直前まで) から SB 以降の HL7 本文を取り出す。"""
+    sb = buf.find(SB, start, end)
+    if sb == -1 or end <= sb + 1:
+        return ""
+    # frame を bytes に切り出さず、受信バッファから直接 decode する
+    with memoryview(buf) as view:
+        return str(view[sb + 1 : end], "utf-8", "ignore")
+
+
+def _split_frames(buf: bytearray, scan_from: int, size: int) -> Tuple[List[str], int]:
+    """buf[:size] にある完結した frame の本文と、消費したバイト数を返す。"""
+    messages = []
+    start = 0
+    end = buf.find(EB_CR, scan_from, size)
+    while end != -1:
+        message = _extract_mllp_payload(buf, start, end)
+        if message:
+            messages.append(message)
+        start = end + len(EB_CR)
+        end = buf.find(EB_CR, start, size)
+    return messages, start
+
+
+class _ClientConnection:
+    """1 接続分の未完了 frame と、ワーカーに渡す未処理メッセージのキュー。"""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        # reactor スレッドだけが触る
+        self.buf = bytearray()
+        self.scan_from = 0
+        self.last_active = time.monotonic()
+        # 以下は lock の下で reactor とワーカーが共有する
+        self.lock = threading.Lock()
+        self.pending: Deque[str] = deque()
+        self.scheduled = False  # ワーカーに投入済み（処理中を含む）
+        self.paused = False  # pending が溜まったので selector から外している
+        self.eof = False  # reactor 側は読み終えた。最後に手が空いた側が close する
+        self.failed = False
+
+
+class MLLPReceiver:
+    """selector で全接続を 1 スレッドで読み、完結した frame だけを解析ワーカーに渡す。
+
+    接続ごとに pending を FIFO で 1 つのワーカーが処理するので、同じ接続の ACK と更新の順序は保たれる。
+    無通信の接続はワーカーを占有しない。
+    """
+
+    def __init__(self, aggregator: BedDataAggregator, cache_writer: CacheWriter, workers: int = 8) -> None:
+        self.aggregator = aggregator
+        self.cache_writer = cache_writer
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hl7-parse")
+        self._sel = selectors.DefaultSelector()
+        self._conns: Set[_ClientConnection] = set()
+        self._paused: Set[_ClientConnection] = set()
+        self._read_buf = bytearray(RECV_BUF_SIZE)
+        self._read_mv = memoryview(self._read_buf)
+        # ワーカーから reactor を起こすための socketpair (Windows でも select できるように pipe ではなく socket)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    def serve_forever(self, listener: socket.socket) -> None:
+        listener.setblocking(False)
+        self._sel.register(listener, selectors.EVENT_READ)
+        self._sel.register(self._wake_r, selectors.EVENT_READ)
+        last_sweep = time.monotonic()
+        try:
+            while True:
+                # timeout 付きで待つことで Windows でも Ctrl+C が効く
+                for key, _events in self._sel.select(timeout=1.0):
+                    if key.data is not None:
+                        self._read(key.data)
+                    elif key.fileobj is listener:
+                        self._accept(listener)
+                    else:
+                        self._resume_paused()
+                now = time.monotonic()
+                if now - last_sweep >= 1.0:
+                    self._drop_idle(now)
+                    last_sweep = now
+        finally:
+            self._sel.close()
+            self._pool.shutdown(wait=False)
+            self._wake_r.close()
+            self._wake_w.close()
+
+    def _accept(self, listener: socket.socket) -> None:
+        try:
+            sock, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        # ACK はワーカーが送る。相手が ACK を読まずに送信バッファが埋まったら待たずにその接続を切る
+        sock.setblocking(False)
+        conn = _ClientConnection(sock)
+        self._conns.add(conn)
+        self._sel.register(sock, selectors.EVENT_READ, conn)
+
+    def _read(self, conn: _ClientConnection) -> None:
+        try:
+            n = conn.sock.recv_into(self._read_mv)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            print(f"client error: {exc}")
+            self._drop(conn, keep_pending=False)
             return
-        parsed = parse_hl7_message(message)
-        aggregator.update_from_parsed(parsed)
-        cache_path.write_text(json.dumps(aggregator.snapshot(), ensure_ascii=False, indent=2), encoding="utf-8")
-        conn.sendall(SB + b"MSA|AA|OK" + EB_CR)
-    finally:
-        conn.close()
+        if n == 0:
+            self._drop(conn, keep_pending=True)
+            return
+        conn.last_active = time.monotonic()
+
+        # TCP の区切りと MLLP frame は一致しないので、未完了の frame だけを接続ごとに持ち越す
+        if conn.buf:
+            conn.buf += self._read_mv[:n]
+            messages, consumed = _split_frames(conn.buf, conn.scan_from, len(conn.buf))
+            del conn.buf[:consumed]
+        else:
+            messages, consumed = _split_frames(self._read_buf, 0, n)
+            conn.buf += self._read_mv[consumed:n]
+        if len(conn.buf) > MAX_FRAME_SIZE:
+            print(f"client error: MLLP frame exceeds {MAX_FRAME_SIZE} bytes")
+            self._drop(conn, keep_pending=False)
+            return
+        # 末尾 1 byte は EB_CR の前半 (\x1c) の可能性があるので次回の探索に含める
+        conn.scan_from = max(len(conn.buf) - len(EB_CR) + 1, 0)
+        if messages:
+            self._dispatch(conn, messages)
+
+    def _dispatch(self, conn: _ClientConnection, messages: List[str]) -> None:
+        with conn.lock:
+            conn.pending.extend(messages)
+            pause = len(conn.pending) >= MAX_PENDING_FRAMES
+            if pause:
+                conn.paused = True
+            submit = not conn.scheduled
+            conn.scheduled = True
+        if pause:
+            # 解析が追いつくまでこの接続は読まない（TCP のフロー制御で送信側が待つ）
+            self._sel.unregister(conn.sock)
+            self._paused.add(conn)
+        if submit:
+            self._pool.submit(self._drain, conn)
+
+    def _drain(self, conn: _ClientConnection) -> None:
+        while True:
+            with conn.lock:
+                if conn.failed or not conn.pending:
+                    conn.scheduled = False
+                    close_now = conn.eof
+                    wake = conn.paused
+                    break
+                message = conn.pending.popleft()
+            try:
+                parsed = parse_hl7_message(message)
+                self.aggregator.update_from_parsed(parsed)
+                self.cache_writer.schedule()
+                conn.sock.sendall(ACK_FRAME)
+            except Exception as exc:
+                print(f"client error: {exc}")
+                with conn.lock:
+                    conn.failed = True
+                    conn.pending.clear()
+                # selector からの削除と close は reactor に任せる（EOF として見える）
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        if close_now:
+            conn.sock.close()
+        elif wake:
+            try:
+                self._wake_w.send(b"\0")
+            except OSError:
+                # 送信バッファが埋まっているなら起床通知はもう届いている
+                pass
+
+    def _resume_paused(self) -> None:
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        for conn in list(self._paused):
+            with conn.lock:
+                if conn.scheduled:
+                    continue
+                conn.paused = False
+            self._paused.discard(conn)
+            conn.last_active = time.monotonic()
+            self._sel.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def _drop_idle(self, now: float) -> None:
+        for conn in list(self._conns):
+            if conn in self._paused or now - conn.last_active <= CLIENT_IDLE_TIMEOUT_S:
+                continue
+            with conn.lock:
+                busy = conn.scheduled
+            if not busy:
+                self._drop(conn, keep_pending=False)
 
+    def _drop(self, conn: _ClientConnection, keep_pending: bool) -> None:
+        """reactor スレッドから呼ぶ。処理中の pending が残っていればワーカーが最後に close する。"""
+        self._sel.unregister(conn.sock)
+        self._conns.discard(conn)
+        with conn.lock:
+            conn.eof = True
+            if not keep_pending:
+                conn.pending.clear()
+            close_now = not conn.scheduled
+        if close_now:
+            conn.sock.close()
 
-def serve(host: str, port: int, cache_path: Path) -> None:
+
+def serve(host: str, port: int, cache_path: Path, workers: int = 8) -> None:
     aggregator = BedDataAggregator()
     cache_path.parent.mkdir(parents=True, exist_ok=True)
-    cache_path.write_text(json.dumps(aggregator.snapshot()), encoding="utf-8")
+    cache_writer = CacheWriter(aggregator, cache_path)
+    cache_writer.flush()
+    cache_writer.start()
 
+    receiver = MLLPReceiver(aggregator, cache_writer, workers=workers)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
-        s.listen(5)
+        s.listen(socket.SOMAXCONN)
         print(f"HL7 receiver listening on {host}:{port}")
-        while True:
-            conn, _ = s.accept()
-            threading.Thread(target=_handle_client, args=(conn, aggregator, cache_path), daemon=True).start()
+        receiver.serve_forever(s)
 
 
 def main() -> None:
@@ -76,8 +373,9 @@ def main() -> None:
     ap.add_argument("--host", default="0.0.0.0")
     ap.add_argument("--port", type=int, default=2575)
     ap.add_argument("--cache", default="monitor_cache.json")
+    ap.add_argument("--workers", type=int, default=8, help="HL7 の解析に使うワーカースレッド数")
     args = ap.parse_args()
-    serve(args.host, args.port, Path(args.cache))
+    serve(args.host, args.port, Path(args.cache), workers=args.workers)
 
 
 if __name__ == "__main__":
@@ -8,8 +8,13 @@ from tkinter import ttk
 
 from PIL import ImageTk
 
-from dm_codec import encode_payload
-from dm_payload import make_payload
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
+
+from dm_codec import encode_frame
+from dm_payload import make_payload_frame
 from dm_render import render_datamatrix
 
 
@@ -20,6 +25,7 @@ class MonitorApp:
         self.refresh_ms = refresh_ms
         self.seq = 0
         self.dm_photo = None
+        self._last_dm_key = None
 
         self.root.title("Central Monitor + DataMatrix")
         self.root.geometry("1200x700")
@@ -38,7 +44,9 @@ class MonitorApp:
         if not self.cache_path.exists():
             return {"beds": {}}
         try:
-            return json.loads(self.cache_path.read_text(encoding="utf-8"))
+            data = self.cache_path.read_bytes()
+            # receiver は UTF-8 の bytes で書くので、decode せずにそのまま読む
+            return orjson.loads(data) if orjson is not None else json.loads(data)
         except Exception as exc:
             self.status_var.set(f"cache load error: {exc}")
             return {"beds": {}}
@@ -56,12 +64,20 @@ class MonitorApp:
             self.text.insert(tk.END, "\n")
 
     def _update_dm(self, cache: dict) -> None:
+        # receiver は更新のたびに bed の ts を書き換えるので、(bed, ts) が同じなら DataMatrix も同じ
+        dm_key = tuple(
+            (bed, info.get("ts") if isinstance(info, dict) else None) for bed, info in cache.get("beds", {}).items()
+        )
+        if dm_key == self._last_dm_key:
+            return
+
         self.seq += 1
-        payload = make_payload(cache, seq=self.seq, schema_version=1)
-        blob = encode_payload(payload)
+        payload, frame = make_payload_frame(cache, seq=self.seq, schema_version=1)
+        blob = encode_frame(frame)
         dm_image = render_datamatrix(blob, size=320)
         self.dm_photo = ImageTk.PhotoImage(dm_image)
         self.dm_label.configure(image=self.dm_photo)
+        self._last_dm_key = dm_key
         self.status_var.set(f"seq={self.seq} crc={payload['crc32']} bytes={len(blob)}")
 
     def tick(self) -> None:
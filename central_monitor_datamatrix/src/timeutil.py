@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+import time
+from typing import Tuple
+
+# (epoch秒, "YYYY-MM-DDTHH:MM:SS")。秒が変わった時だけ strftime し直す。
+_prefix_cache: Tuple[int, str] = (-1, "")
+
+
+def utcnow_iso() -> str:
+    """datetime.now(timezone.utc).isoformat() 相当 (マイクロ秒は常に6桁)。"""
+    global _prefix_cache
+    t = time.time()
+    sec = int(t)
+    cached_sec, prefix = _prefix_cache
+    if cached_sec != sec:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+        _prefix_cache = (sec, prefix)
+    return f"{prefix}.{int((t - sec) * 1_000_000):06d}+00:00"
@@ -13,7 +13,8 @@ import socket
 import time
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, Tuple
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,7 @@ logger = logging.getLogger(__name__)
 START_BLOCK = b"\x0b"
 END_BLOCK = b"\x1c"
 CARRIAGE_RETURN = b"\x0d"
+FRAME_END = END_BLOCK + CARRIAGE_RETURN
 
 
 @dataclass(frozen=True)
@@ -42,8 +44,11 @@ BEDS = [
 ]
 
 
-def wrap_mllp(message: str) -> bytes:
-    return START_BLOCK + message.encode("utf-8") + END_BLOCK + CARRIAGE_RETURN
+def wrap_mllp(message: Union[str, bytes]) -> bytes:
+    # 既に bytes なら encode し直さずにそのまま包む
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    return b"".join((START_BLOCK, message, FRAME_END))
 
 
 TEMP_VITALS = {"TSKIN", "TRECT"}
@@ -73,50 +78,59 @@ VITAL_SPECS: Dict[str, Tuple[str, str, str]] = {
 }
 
 
+# OBX は値と時刻以外が固定なので、前後の文字列を import 時に組み立てておく
+# (prefix, suffix, key, is_temp): prefix + 値 + suffix + ts + "||"
+_OBX_TEMPLATES = [
+    (f"OBX|{idx}|NM|{key}^{key}||", f"|{unit}|{ref_range}|N|||F|", key, key in TEMP_VITALS)
+    for idx, (key, (unit, ref_range, _value_type)) in enumerate(VITAL_SPECS.items(), start=1)
+]
+
+
+def _vital_ranges() -> List[Tuple[str, float, float, bool]]:
+    """VITAL_SPECS の基準範囲から (key, low, span, is_float) を作る。int は low + [0, span) で引く。"""
+    ranges = []
+    for key, (_unit, ref_range, value_type) in VITAL_SPECS.items():
+        low_text, high_text = ref_range.split("-")
+        if value_type == "float":
+            ranges.append((key, float(low_text), float(high_text) - float(low_text), True))
+        else:
+            ranges.append((key, int(low_text), int(high_text) - int(low_text) + 1, False))
+    return ranges
+
+
+_VITAL_RANGES = _vital_ranges()
+
+
 def make_vitals() -> Dict[str, float]:
+    rand = random.random
     return {
-        "HR": random.randint(60, 160),
-        "ART_S": random.randint(70, 140),
-        "ART_D": random.randint(40, 90),
-        "ART_M": random.randint(50, 110),
-        "CVP_M": random.randint(0, 20),
-        "RAP_M": random.randint(0, 20),
-        "SpO2": random.randint(85, 100),
-        "TSKIN": round(random.uniform(34.0, 39.5), 1),
-        "TRECT": round(random.uniform(34.0, 39.5), 1),
-        "rRESP": random.randint(5, 60),
-        "EtCO2": random.randint(20, 60),
-        "RR": random.randint(5, 60),
-        "VTe": random.randint(50, 800),
-        "VTi": random.randint(50, 800),
-        "Ppeak": random.randint(10, 40),
-        "PEEP": random.randint(3, 12),
-        "O2conc": random.randint(21, 100),
-        "NO": random.randint(0, 40),
-        "BSR1": random.randint(0, 100),
-        "BSR2": random.randint(0, 100),
+        key: round(low + rand() * span, 1) if is_float else low + int(rand() * span)
+        for key, low, span, is_float in _VITAL_RANGES
     }
 
 
+@lru_cache(maxsize=None)
+def _patient_segments(profile: BedProfile) -> str:
+    return (
+        f"PID|1||{profile.patient_id}^^^SIMMRN||{profile.patient_name}||19800101|{profile.sex}|||\n"
+        f"PV1|1|I|ICU^01^{profile.bed_id}"
+    )
+
+
 def make_oru_r01(profile: BedProfile) -> str:
     ts = datetime.now().strftime("%Y%m%d%H%M%S")
     msg_id = f"GEN{profile.bed_id}{ts}"
     v = make_vitals()
 
-    obx_segments = []
-    for idx, key in enumerate(VITAL_SPECS.keys(), start=1):
-        unit, ref_range, _value_type = VITAL_SPECS[key]
-        value = v[key]
-        value_text = f"{float(value):.1f}" if key in TEMP_VITALS else str(int(value))
-        obx_segments.append(
-            f"OBX|{idx}|NM|{key}^{key}||{value_text}|{unit}|{ref_range}|N|||F|{ts}||"
-        )
+    obx_segments = "\n".join(
+        f"{prefix}{float(v[key]):.1f}{suffix}{ts}||" if is_temp else f"{prefix}{int(v[key])}{suffix}{ts}||"
+        for prefix, suffix, key, is_temp in _OBX_TEMPLATES
+    )
 
     return f"""MSH|^~\\&|VIRTUAL_CENTRAL|SIMHOSP|MONITOR|WARD|{ts}||ORU^R01|{msg_id}|P|2.5
-PID|1||{profile.patient_id}^^^SIMMRN||{profile.patient_name}||19800101|{profile.sex}|||
-PV1|1|I|ICU^01^{profile.bed_id}
+{_patient_segments(profile)}
 OBR|1||ORD{ts}|VITAL^Vital Signs|||{ts}
-{chr(10).join(obx_segments)}"""
+{obx_segments}"""
 
 
 def send_message(host: str, port: int, message: str) -> bool:
@@ -132,6 +146,75 @@ def send_message(host: str, port: int, message: str) -> bool:
         return False
 
 
+def open_connection(host: str, port: int) -> socket.socket:
+    sock = socket.create_connection((host, port), timeout=5)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    return sock
+
+
+def connection_alive(sock: socket.socket) -> bool:
+    """送信周期の間に receiver 側から閉じられていないかを、読まずに覗いて確かめる。"""
+    try:
+        sock.setblocking(False)
+        try:
+            # FIN を受けていれば b"" が返る。未読の ACK 等が残っている接続も使い回さない
+            sock.recv(1, socket.MSG_PEEK)
+            return False
+        finally:
+            sock.settimeout(5)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+def send_messages(sock: socket.socket, messages: List[str]) -> List[Optional[bool]]:
+    """全メッセージのMLLPフレームを続けて送り、その後で送信順のACKをまとめて読む。
+
+    ACKを受け取れなかったメッセージ(途中で切断された等)は None になる。
+    """
+    sock.sendall(b"".join(wrap_mllp(m) for m in messages))
+    acks = b""
+    try:
+        while acks.count(FRAME_END) < len(messages):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            acks += chunk
+    except socket.timeout:
+        pass
+    results: List[Optional[bool]] = [b"MSA|AA" in ack for ack in acks.split(FRAME_END)[: acks.count(FRAME_END)]]
+    return results + [None] * (len(messages) - len(results))
+
+
+def send_persistent(
+    sock: Optional[socket.socket], host: str, port: int, messages: List[str]
+) -> Tuple[Optional[socket.socket], List[bool]]:
+    """接続を使い回して送る。ACKが揃わなければ1回だけ再接続し、ACKの無かった分を送り直す。"""
+    results: List[Optional[bool]] = [None] * len(messages)
+    for _attempt in range(2):
+        pending = [i for i, r in enumerate(results) if r is None]
+        if not pending:
+            break
+        try:
+            if sock is not None and not connection_alive(sock):
+                sock.close()
+                sock = None
+            if sock is None:
+                sock = open_connection(host, port)
+            got = send_messages(sock, [messages[i] for i in pending])
+        except OSError as exc:
+            logger.error("送信エラー: %s", exc)
+            got = [None] * len(pending)
+        for i, ok in zip(pending, got):
+            results[i] = ok
+        if None in got and sock is not None:
+            sock.close()
+            sock = None
+    return sock, [bool(r) for r in results]
+
+
 def str_to_bool(v: str) -> bool:
     return v.lower() in {"1", "true", "yes", "on"}
 
@@ -143,6 +226,12 @@ def main() -> None:
     parser.add_argument("--interval", type=int, default=60, help="送信周期(秒)")
     parser.add_argument("--enabled", default="true", help="falseで無効化")
     parser.add_argument("--count", type=int, default=-1, help="送信ループ回数(-1:無限)")
+    parser.add_argument(
+        "--persistent",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="1本のTCP接続を使い回して全ベッド分をまとめて送る(既定はメッセージ毎に接続。1接続1メッセージの receiver 向け)",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -151,14 +240,23 @@ def main() -> None:
         logger.info("generatorは無効化されています。終了します。")
         return
 
+    sock: Optional[socket.socket] = None
     loop = 0
-    while args.count < 0 or loop < args.count:
-        logger.info("%d回目の送信を開始", loop + 1)
-        for bed in BEDS:
-            ok = send_message(args.host, args.port, make_oru_r01(bed))
-            logger.info("bed=%s send=%s", bed.bed_id, "OK" if ok else "NG")
-        loop += 1
-        time.sleep(args.interval)
+    try:
+        while args.count < 0 or loop < args.count:
+            logger.info("%d回目の送信を開始", loop + 1)
+            messages = [make_oru_r01(bed) for bed in BEDS]
+            if args.persistent:
+                sock, results = send_persistent(sock, args.host, args.port, messages)
+            else:
+                results = [send_message(args.host, args.port, m) for m in messages]
+            for bed, ok in zip(BEDS, results):
+                logger.info("bed=%s send=%s", bed.bed_id, "OK" if ok else "NG")
+            loop += 1
+            time.sleep(args.interval)
+    finally:
+        if sock is not None:
+            sock.close()
 
 
 if __name__ == "__main__":
@@ -5,12 +5,46 @@ import re
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass, field
 from datetime import datetime
+from functools import lru_cache
 import logging
 
 logger = logging.getLogger(__name__)
 
+_TZ_RE = re.compile(r'[+\-]\d{4}$')
+_NUM_RE = re.compile(r'[^\d.\-+]')
+# 文字列長 (14 で頭打ち) -> 解釈する桁数。8 桁未満は 0 (解釈しない)、10-11 桁は時を捨てて日付のみ
+_DT_PRECISION = (0,) * 8 + (8, 8, 8, 8, 12, 12, 14)
+# Latin-1 範囲で数値に使う文字以外を削除する translate テーブル(_NUM_RE と同じ結果になる範囲)
+_NUM_DELETE_TABLE = str.maketrans('', '', ''.join(chr(i) for i in range(256) if chr(i) not in '0123456789.+-'))
+
+
+# 1 メッセージ内の MSH / OBX や同じモニタからの連続メッセージは同じ時刻文字列を繰り返すのでキャッシュする
+@lru_cache(maxsize=1024)
+def _parse_datetime_cached(hl7_datetime: str) -> Optional[datetime]:
+    if not hl7_datetime:
+        return None
+    try:
+        dt_str = _TZ_RE.sub('', hl7_datetime)
+        # YYYYMMDD[HHMM[SS]] は固定長なので strptime を使わずスライスして int() する
+        n = _DT_PRECISION[min(len(dt_str), 14)]
+        if not n:
+            return None
+        dt_str = dt_str[:n]
+        if not (dt_str.isascii() and dt_str.isdigit()):
+            return None
+        return datetime(
+            int(dt_str[0:4]),
+            int(dt_str[4:6]),
+            int(dt_str[6:8]),
+            int(dt_str[8:10]) if n >= 12 else 0,
+            int(dt_str[10:12]) if n >= 12 else 0,
+            int(dt_str[12:14]) if n >= 14 else 0,
+        )
+    except ValueError:
+        return None
+
 
-@dataclass
+@dataclass(slots=True)
 class HL7VitalSign:
     observation_id: str
     observation_name: str
@@ -22,7 +56,7 @@ class HL7VitalSign:
     status: str = "F"
 
 
-@dataclass
+@dataclass(slots=True)
 class HL7Message:
     message_type: str
     message_datetime: datetime
@@ -73,7 +107,12 @@ class HL7Parser:
         "ICU_BSR2": "BSR2",
     }
 
-    def __init__(self):
+    # DIRECT_VITAL_KEYS は自分自身へ写すようにして、OBX ごとの名前解決を 1 回の dict 参照にまとめる
+    _VITAL_LOOKUP = {**OBSERVATION_MAPPING, **{key: key for key in DIRECT_VITAL_KEYS}}
+
+    def __init__(self, debug: bool = False):
+        # debug=True の時だけ HL7Message.raw_message に受信文字列を残す
+        self.debug = debug
         self.field_separator = "|"
         self.component_separator = "^"
         self.repetition_separator = "~"
@@ -102,19 +141,7 @@ class HL7Parser:
         return field.split(self.component_separator)
 
     def parse_datetime(self, hl7_datetime: str) -> Optional[datetime]:
-        if not hl7_datetime:
-            return None
-        try:
-            dt_str = re.sub(r'[+\-]\d{4}$', '', hl7_datetime)
-            if len(dt_str) >= 14:
-                return datetime.strptime(dt_str[:14], "%Y%m%d%H%M%S")
-            if len(dt_str) >= 12:
-                return datetime.strptime(dt_str[:12], "%Y%m%d%H%M")
-            if len(dt_str) >= 8:
-                return datetime.strptime(dt_str[:8], "%Y%m%d")
-            return None
-        except ValueError:
-            return None
+        return _parse_datetime_cached(hl7_datetime)
 
     def parse_msh(self, fields: List[str]) -> Tuple[str, datetime]:
         message_type = ""
@@ -131,10 +158,10 @@ class HL7Parser:
         patient_id = ""
         patient_name = ""
         if len(fields) > 3:
-            components = self.split_component(fields[3])
+            components = fields[3].split(self.component_separator)
             patient_id = components[0] if components else ""
         if len(fields) > 5:
-            components = self.split_component(fields[5])
+            components = fields[5].split(self.component_separator)
             if len(components) >= 2:
                 patient_name = f"{components[0]} {components[1]}"
             elif components:
@@ -144,7 +171,7 @@ class HL7Parser:
     def parse_pv1_bed(self, fields: List[str]) -> str:
         if len(fields) <= 3:
             return ""
-        location = self.split_component(fields[3])
+        location = fields[3].split(self.component_separator)
         if len(location) >= 2:
             return location[1]
         return location[0] if location else ""
@@ -154,18 +181,22 @@ class HL7Parser:
             return None
         if fields[2] not in ["NM", "SN"]:
             return None
-        obs_components = self.split_component(fields[3])
+        obs_components = fields[3].split(self.component_separator)
         observation_id = obs_components[0] if obs_components else ""
         observation_name_raw = obs_components[1] if len(obs_components) > 1 else ""
-        if observation_id in self.DIRECT_VITAL_KEYS:
-            observation_name = observation_id
-        else:
-            observation_name = self.OBSERVATION_MAPPING.get(observation_id, observation_name_raw)
+        observation_name = self._VITAL_LOOKUP.get(observation_id, observation_name_raw)
 
         value = None
         value_str = fields[5]
         if value_str:
-            cleaned = re.sub(r'[^\d.\-+]', '', value_str)
+            # 既に数値だけの文字列なら正規表現を通さない
+            if value_str.replace('.', '', 1).lstrip('-+').isdecimal():
+                cleaned = value_str
+            else:
+                cleaned = value_str.translate(_NUM_DELETE_TABLE)
+                # "℃" や全角文字などテーブル外の文字が残った場合だけ正規表現で落とす
+                if not cleaned.isascii():
+                    cleaned = _NUM_RE.sub('', cleaned)
             if cleaned:
                 try:
                     value = float(cleaned)
@@ -178,15 +209,16 @@ class HL7Parser:
         status = fields[11] if len(fields) > 11 else "F"
         obs_time = self.parse_datetime(fields[14]) if len(fields) > 14 else None
 
+        # OBX ごとに作るので、キーワード引数の解釈を避けてフィールド定義順の位置引数で渡す
         return HL7VitalSign(
-            observation_id=observation_id,
-            observation_name=observation_name,
-            value=value,
-            unit=unit,
-            reference_range=reference_range,
-            abnormal_flag=abnormal_flag,
-            observation_time=obs_time,
-            status=status,
+            observation_id,
+            observation_name,
+            value,
+            unit,
+            reference_range,
+            abnormal_flag,
+            obs_time,
+            status,
         )
 
     def parse_pv1(self, fields: List[str]) -> str:
@@ -199,7 +231,7 @@ class HL7Parser:
         if len(fields) <= 3:
             return ""
 
-        location = self.split_component(fields[3])
+        location = fields[3].split(self.component_separator)
         if not location:
             return ""
 
@@ -213,11 +245,18 @@ class HL7Parser:
     def parse(self, hl7_message: str) -> Optional[HL7Message]:
         if not hl7_message:
             return None
-        segments = [s.strip() for s in hl7_message.splitlines() if s.strip()]
-        if not segments or not segments[0].startswith("MSH"):
+        # HL7 のセグメント区切りは \r なので、\n / \r\n の入力だけ 1 回置換してから split する
+        text = hl7_message.strip()
+        if not text.startswith("MSH"):
             return None
+        if "\n" in text:
+            text = text.replace("\r\n", "\r").replace("\n", "\r")
+        segments = text.split("\r")
 
         self.parse_encoding_characters(segments[0])
+        # ループ内で毎回 self 属性を引かないようローカルに束縛する
+        fs = self.field_separator
+        parse_obx = self.parse_obx
         message_type = ""
         message_datetime = datetime.now()
         patient_id = ""
@@ -226,20 +265,22 @@ class HL7Parser:
         vitals = {}
 
         for segment in segments:
+            if len(segment) < 3:
+                continue
             segment_type = segment[:3]
-            fields = self.split_segment(segment)
-            if segment_type == "MSH":
-                message_type, message_datetime = self.parse_msh(fields)
+            # ORU^R01 はほとんどが OBX なので最初に判定する
+            if segment_type == "OBX":
+                vital = parse_obx(segment.split(fs))
+                if vital and vital.observation_name:
+                    vitals[vital.observation_name] = vital
+
+            elif segment_type == "MSH":
+                message_type, message_datetime = self.parse_msh(segment.split(fs))
             elif segment_type == "PID":
-                patient_id, patient_name = self.parse_pid(fields)
+                patient_id, patient_name = self.parse_pid(segment.split(fs))
 
             elif segment_type == "PV1":
-                bed_id = self.parse_pv1(fields)
-
-            elif segment_type == "OBX":
-                vital = self.parse_obx(fields)
-                if vital and vital.observation_name:
-                    vitals[vital.observation_name] = vital
+                bed_id = self.parse_pv1(segment.split(fs))
 
         return HL7Message(
             message_type=message_type,
@@ -248,7 +289,7 @@ class HL7Parser:
             patient_name=patient_name,
             bed_id=bed_id,
             vitals=vitals,
-            raw_message=hl7_message,
+            raw_message=hl7_message if self.debug else "",
         )
 
 